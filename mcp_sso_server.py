@@ -1,15 +1,21 @@
 # mcp_sso_server.py
 
 import os
+import asyncio
 import logging
-from typing import Optional, Dict, Any
+import secrets
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, Any, Tuple
 
 import httpx
+import orjson
+from cachetools import TTLCache
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute
+from fastapi.responses import ORJSONResponse, Response
 
-from fastmcp import FastMCP
+from fastmcp import FastMCP, Context
 
 # ---------------------------------------------------------------------------
 # Config
@@ -17,6 +23,33 @@ from fastmcp import FastMCP
 
 BACKEND_BASE_URL = os.getenv("BACKEND_BASE_URL", "http://localhost:8000")
 
+# Connection pool for the shared backend client (size to expected MCP fan-out)
+MCP_HTTP_MAX_CONN = int(os.getenv("MCP_HTTP_MAX_CONN", "500"))
+MCP_HTTP_MAX_KEEPALIVE = int(os.getenv("MCP_HTTP_MAX_KEEPALIVE", "100"))
+MCP_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("MCP_HTTP_KEEPALIVE_EXPIRY", "30"))
+# Offer HTTP/2 to the backend (negotiated via TLS ALPN; plain http:// stays HTTP/1.1)
+MCP_HTTP2 = os.getenv("MCP_HTTP2", "true").lower() == "true"
+
+# Browser origins allowed to call the agent with credentials (comma-separated;
+# no "*" - credentialed CORS needs explicit origins)
+CORS_ORIGINS = frozenset(
+    origin.strip()
+    for origin in os.getenv(
+        "CORS_ORIGINS",
+        "http://localhost:5500,http://127.0.0.1:5500,http://localhost:3000,http://127.0.0.1:3000",
+    ).split(",")
+    if origin.strip()
+)
+
+# Per-client agent sessions: cookie name, absolute session lifetime (seconds),
+# capacity. Sessions expire this long after login; access does not extend them.
+AGENT_SESSION_COOKIE = os.getenv("AGENT_SESSION_COOKIE", "agent_session")
+AGENT_SESSION_TTL = int(os.getenv("AGENT_SESSION_TTL", "3600"))
+AGENT_SESSION_MAX = int(os.getenv("AGENT_SESSION_MAX", "10000"))
+
+# Backend session cookie name (carries the id_token on backend calls)
+SSO_COOKIE_NAME = os.getenv("COOKIE_NAME", "sso_session")
+
 LOG_LEVEL = os.getenv("LOG_LEVEL", "info").upper()
 logging.basicConfig(
     level=getattr(logging, LOG_LEVEL, logging.INFO),
@@ -24,28 +57,97 @@ logging.basicConfig(
 )
 logger = logging.getLogger("mcp_sso_server")
 
-# In-memory cookie jar for the MCP agent session (demo only)
-session_cookies: Dict[str, Any] = {}
-
 # ---------------------------------------------------------------------------
 # FastAPI app for browser + HTTP clients
 # ---------------------------------------------------------------------------
 
-app = FastAPI(title="SSO MCP Server")
+class ORJSONRoute(APIRoute):
+    """
+    Route that pre-parses JSON request bodies with orjson, so a later
+    `await request.json()` returns the cached result. Invalid JSON is left
+    for request.json() to reject as usual.
+    """
+
+    def get_route_handler(self):
+        original = super().get_route_handler()
+
+        async def custom_route_handler(request: Request):
+            body = await request.body()
+            if body:
+                try:
+                    request._json = orjson.loads(body)
+                except orjson.JSONDecodeError:
+                    pass
+            return await original(request)
+
+        return custom_route_handler
+
+
+async def check_backend(client: httpx.AsyncClient) -> bool:
+    """Check that the backend answers /health (logs the result, never raises)"""
+    try:
+        resp = await client.get("/health", timeout=2.0)
+        if resp.is_success:
+            logger.info("✅ Backend %s is REACHABLE (%s)", BACKEND_BASE_URL, resp.http_version)
+            if MCP_HTTP2 and resp.http_version != "HTTP/2":
+                logger.info("Backend did not negotiate HTTP/2; calls use pooled HTTP/1.1")
+            return True
+        logger.error("❌ Backend %s/health returned %s", BACKEND_BASE_URL, resp.status_code)
+        return False
+    except httpx.HTTPError as e:
+        logger.error("❌ Backend %s is NOT reachable: %s", BACKEND_BASE_URL, e)
+        return False
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Create one shared AsyncClient for the app lifetime so HTTP endpoints and
+    MCP tools reuse the same keep-alive connection pool to the backend.
+    Also runs the mounted MCP app's lifespan (its session manager needs it).
+
+    Sessions (the id_token from /auth/exchange) expire after
+    AGENT_SESSION_TTL seconds. Browser sessions (keyed by the agent session
+    cookie) and MCP sessions (keyed by the MCP session id) live in separate
+    caches, so a cookie value can never address an MCP client's session.
+    """
+    app.state.sessions = TTLCache(maxsize=AGENT_SESSION_MAX, ttl=AGENT_SESSION_TTL)
+    app.state.mcp_sessions = TTLCache(maxsize=AGENT_SESSION_MAX, ttl=AGENT_SESSION_TTL)
+    app.state.http = httpx.AsyncClient(
+        base_url=BACKEND_BASE_URL,
+        follow_redirects=False,
+        timeout=30.0,
+        http2=MCP_HTTP2,
+        limits=httpx.Limits(
+            max_connections=MCP_HTTP_MAX_CONN,
+            max_keepalive_connections=MCP_HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=MCP_HTTP_KEEPALIVE_EXPIRY,
+        ),
+    )
+    logger.info("Testing backend connectivity...")
+    await check_backend(app.state.http)
+    try:
+        async with mcp_app.lifespan(app):
+            yield
+    finally:
+        await app.state.http.aclose()
+
+
+app = FastAPI(
+    title="SSO MCP Server",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
+)
+# Must be set before any route is declared
+app.router.route_class = ORJSONRoute
 
-# CORS for your static HTML (adjust origins if needed)
+# CORS for your static HTML (set CORS_ORIGINS to adjust origins)
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=[
-        "http://localhost:5500",
-        "http://127.0.0.1:5500",
-        "http://localhost:3000",
-        "http://127.0.0.1:3000",
-        "*",  # demo: allow all; tighten this in prod
-    ],
+    allow_origins=list(CORS_ORIGINS),
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["content-type", "authorization"],
 )
 
 # ---------------------------------------------------------------------------
@@ -54,11 +156,47 @@ app.add_middleware(
 
 mcp = FastMCP("SSO MCP Server")
 
-# ------------------------ MCP TOOLS (LLM side) -----------------------------
+# ------------------------ Session helpers ----------------------------------
 
 
-@mcp.tool()
-def sso_login() -> dict:
+def session_cookie_header(session: Dict[str, Any]) -> Dict[str, str]:
+    """
+    Build the backend session Cookie header from the session's id_token.
+    (The shared client has no per-user cookie jar.)
+    """
+    id_token = session.get("id_token")
+    if not id_token:
+        return {}
+    return {"Cookie": f"{SSO_COOKIE_NAME}={id_token}"}
+
+
+def get_session(request: Request) -> Dict[str, Any]:
+    """
+    Return the browser's agent session (holds the id_token).
+    Empty if the browser has no agent session or it has expired.
+    """
+    session_id = request.cookies.get(AGENT_SESSION_COOKIE)
+    if not session_id:
+        return {}
+    return app.state.sessions.get(session_id, {})
+
+
+def get_mcp_session(ctx: Context) -> Dict[str, Any]:
+    """
+    Return the MCP client's session (holds the id_token).
+    Empty if the transport has no MCP session id or the session has expired.
+    """
+    if not ctx.session_id:
+        return {}
+    return app.state.mcp_sessions.get(ctx.session_id, {})
+
+
+# ------------------------ Backend calls (shared) ---------------------------
+# Each returns (status_code, body): MCP tools use the body, HTTP endpoints
+# use both without re-inspecting the body.
+
+
+async def _sso_login() -> Tuple[int, dict]:
     """
     Start SSO login and return the Azure auth URL.
 
@@ -67,100 +205,162 @@ def sso_login() -> dict:
     - MCP tool (LLM client)
     """
     try:
-        with httpx.Client(base_url=BACKEND_BASE_URL, follow_redirects=False) as client:
-            resp = client.get("/auth/login")
-            if resp.is_redirect:
-                auth_url = resp.headers.get("location")
-                logger.info("SSO login initiated, auth_url obtained")
-                return {"auth_url": auth_url}
-            # Non-redirect – try to parse JSON error
-            try:
-                return resp.json()
-            except Exception as e:
-                logger.error(f"Login failed (no JSON body): {e}")
-                return {"error": "login failed"}
+        resp = await app.state.http.get("/auth/login")
+        if resp.is_redirect:
+            auth_url = resp.headers.get("location")
+            logger.info("SSO login initiated, auth_url obtained")
+            return 200, {"auth_url": auth_url}
+        # Non-redirect – try to parse JSON error
+        try:
+            return 500, resp.json()
+        except Exception as e:
+            logger.error("Login failed (no JSON body): %s", e)
+            return 500, {"error": "login failed"}
     except Exception as e:
-        logger.error(f"Connection error during login: {e}")
-        return {"error": f"connection_error: {str(e)}"}
+        logger.error("Connection error during login: %s", e)
+        return 500, {"error": f"connection_error: {str(e)}"}
 
 
-@mcp.tool()
-def sso_callback(code: str, state: Optional[str] = None) -> dict:
+async def _sso_callback(
+    session: Dict[str, Any], code: str, state: Optional[str] = None
+) -> Tuple[int, dict]:
     """
-    Handle SSO callback and store session cookies for the MCP agent.
+    Handle SSO callback and store the id_token into session.
+    Uses the backend /auth/exchange endpoint (token as JSON, no redirect).
     """
     try:
         logger.info("sso_callback called")
-        params = {"code": code}
+        payload = {"code": code}
         if state:
-            params["state"] = state
-
-        with httpx.Client(base_url=BACKEND_BASE_URL, follow_redirects=False) as client:
-            resp = client.get("/auth/callback", params=params)
-
-            # Store cookies from backend in our in-memory jar
-            if resp.cookies:
-                session_cookies.clear()
-                session_cookies.update(resp.cookies)
-                logger.info(f"Session cookies stored: {len(resp.cookies)} cookie(s)")
-
-            if resp.is_redirect:
-                # In our backend, /auth/callback redirects to /post-login
-                logger.info("Callback successful, session established")
-                return {"status": "OK"}
-
-            # If backend returned JSON instead of redirect, pass it through
-            try:
-                return resp.json()
-            except Exception as e:
-                logger.error(f"Callback failed (no JSON body): {e}")
-                return {"error": "callback failed"}
+            payload["state"] = state
+
+        resp = await app.state.http.post("/auth/exchange", json=payload)
+
+        if resp.status_code == 200:
+            tokens = resp.json()
+            session["id_token"] = tokens["id_token"]
+            logger.info("Exchange successful, session established")
+            return 200, {"status": "OK"}
+
+        # Backend rejected the code - pass its JSON error through
+        try:
+            return 500, resp.json()
+        except Exception as e:
+            logger.error("Callback failed (no JSON body): %s", e)
+            return 500, {"error": "callback failed"}
     except Exception as e:
-        logger.error(f"Connection error during callback: {e}")
-        return {"error": f"connection_error: {str(e)}"}
+        logger.error("Connection error during callback: %s", e)
+        return 500, {"error": f"connection_error: {str(e)}"}
 
 
-@mcp.tool()
-def sso_me() -> dict:
+async def _sso_me(session: Dict[str, Any]) -> Tuple[int, dict]:
     """
     Get user info if authenticated.
-    Uses the session_cookies stored during sso_callback.
+    Uses the id_token stored during sso_callback.
     """
     try:
-        with httpx.Client(base_url=BACKEND_BASE_URL, cookies=session_cookies) as client:
-            resp = client.get("/auth/me")
-            result = resp.json()
-            if resp.status_code == 200:
-                logger.info(
-                    f"User info retrieved: "
-                    f"{result.get('user', {}).get('email', 'unknown')}"
-                )
-            else:
-                logger.debug(f"Not authenticated or error: {result}")
-            return result
+        resp = await app.state.http.get("/auth/me", headers=session_cookie_header(session))
+        result = resp.json()
+        if resp.status_code == 200:
+            logger.info(
+                "User info retrieved: %s",
+                result.get('user', {}).get('email', 'unknown'),
+            )
+        else:
+            logger.debug("Not authenticated or error: %s", result)
+        return (200 if resp.status_code == 200 else 401), result
     except Exception as e:
-        logger.error(f"Error getting user info: {e}")
-        return {"error": f"me failed: {str(e)}"}
+        logger.error("Error getting user info: %s", e)
+        return 401, {"error": f"me failed: {str(e)}"}
 
 
-@mcp.tool()
-def sso_logout() -> dict:
+async def _sso_logout(session: Dict[str, Any]) -> Tuple[int, dict]:
     """
-    Logout and clear MCP agent session cookies.
+    Logout and clear the given session.
     """
     try:
-        with httpx.Client(base_url=BACKEND_BASE_URL, cookies=session_cookies) as client:
-            resp = client.post("/auth/logout")
-            session_cookies.clear()
-            logger.info("User logged out, session cleared")
-            try:
-                return resp.json()
-            except Exception as e:
-                logger.error(f"Logout response parse error: {e}")
-                return {"error": "logout failed"}
+        resp = await app.state.http.post("/auth/logout", headers=session_cookie_header(session))
+        session.clear()
+        logger.info("User logged out, session cleared")
+        try:
+            return (200 if resp.is_success else 500), resp.json()
+        except Exception as e:
+            logger.error("Logout response parse error: %s", e)
+            return 500, {"error": "logout failed"}
     except Exception as e:
-        logger.error(f"Connection error during logout: {e}")
-        return {"error": f"connection_error: {str(e)}"}
+        logger.error("Connection error during logout: %s", e)
+        return 500, {"error": f"connection_error: {str(e)}"}
+
+
+async def gather_bodies(*calls) -> list:
+    """
+    Run independent backend calls concurrently; return their bodies in order.
+    The _sso_* helpers never raise, so one failure cannot cancel the others.
+    """
+    return [body for _, body in await asyncio.gather(*calls)]
+
+
+# ------------------------ MCP TOOLS (LLM side) -----------------------------
+
+
+@mcp.tool()
+async def sso_login() -> dict:
+    """
+    Start SSO login and return the Azure auth URL.
+    """
+    _, result = await _sso_login()
+    return result
+
+
+@mcp.tool()
+async def sso_callback(code: str, ctx: Context, state: Optional[str] = None) -> dict:
+    """
+    Handle SSO callback and store the id_token for this MCP session.
+    """
+    if not ctx.session_id:
+        # Without an id every such client would share one session
+        return {"error": "no MCP session id: connect over the streamable HTTP transport"}
+    session: Dict[str, Any] = {}
+    _, result = await _sso_callback(session, code=code, state=state)
+    if session:
+        app.state.mcp_sessions[ctx.session_id] = session
+    return result
+
+
+@mcp.tool()
+async def sso_me(ctx: Context) -> dict:
+    """
+    Get user info if this MCP session is authenticated.
+    """
+    _, result = await _sso_me(get_mcp_session(ctx))
+    return result
+
+
+@mcp.tool()
+async def sso_logout(ctx: Context) -> dict:
+    """
+    Logout and clear this MCP session.
+    """
+    session = app.state.mcp_sessions.pop(ctx.session_id, {}) if ctx.session_id else {}
+    _, result = await _sso_logout(session)
+    return result
+
+
+@mcp.tool()
+async def sso_status_and_login_url(ctx: Context) -> dict:
+    """
+    Get this MCP session's user info and a fresh Azure auth URL in one call.
+    Both backend requests run concurrently; use auth_url only if "me" shows
+    the session is not authenticated.
+    """
+    me, login = await gather_bodies(
+        _sso_me(get_mcp_session(ctx)),
+        _sso_login(),
+    )
+    result = {"me": me, "auth_url": login.get("auth_url")}
+    if "error" in login:
+        result["login_error"] = login["error"]
+    return result
 
 
 # ---------------------------------------------------------------------------
@@ -174,9 +374,10 @@ async def sso_login_http(request: Request):
     Browser-accessible endpoint: POST /sso_login
     """
     logger.info("HTTP /sso_login called")
-    result = sso_login()
-    status_code = 200 if "error" not in result else 500
-    return JSONResponse(result, status_code=status_code)
+    status_code, result = await _sso_login()
+    return Response(
+        content=orjson.dumps(result), status_code=status_code, media_type="application/json"
+    )
 
 
 @app.post("/sso_callback")
@@ -184,18 +385,44 @@ async def sso_callback_http(request: Request):
     """
     Browser-accessible endpoint: POST /sso_callback
     Body: { "code": "...", "state": "..."? }
+    On success, sets a freshly issued agent session cookie for this browser.
     """
     logger.info("HTTP /sso_callback called")
-    body = await request.json()
+    try:
+        body = await request.json()
+    except Exception as e:
+        logger.error("Failed to parse request body: %s", e)
+        return ORJSONResponse({"error": "invalid JSON body"}, status_code=400)
+
     code = body.get("code")
     state = body.get("state")
 
     if not code:
-        return JSONResponse({"error": "missing code"}, status_code=400)
-
-    result = sso_callback(code=code, state=state)
-    status_code = 200 if result.get("status") == "OK" and "error" not in result else 500
-    return JSONResponse(result, status_code=status_code)
+        return ORJSONResponse({"error": "missing code"}, status_code=400)
+
+    session: Dict[str, Any] = {}
+    status_code, result = await _sso_callback(session, code=code, state=state)
+    response = Response(
+        content=orjson.dumps(result), status_code=status_code, media_type="application/json"
+    )
+    if session:
+        # Always issue a fresh server-generated id (never adopt the client's
+        # cookie value) so a planted agent_session cannot be fixated.
+        old_session_id = request.cookies.get(AGENT_SESSION_COOKIE)
+        if old_session_id:
+            app.state.sessions.pop(old_session_id, None)
+        session_id = secrets.token_urlsafe(32)
+        app.state.sessions[session_id] = session
+        response.set_cookie(
+            key=AGENT_SESSION_COOKIE,
+            value=session_id,
+            max_age=AGENT_SESSION_TTL,
+            httponly=True,
+            # LOCAL DEV: set to False so it works over http://localhost
+            secure=False,
+            samesite="lax",
+        )
+    return response
 
 
 @app.post("/sso_me")
@@ -204,9 +431,10 @@ async def sso_me_http(request: Request):
     Browser-accessible endpoint: POST /sso_me
     """
     logger.info("HTTP /sso_me called")
-    result = sso_me()
-    status_code = 200 if "user" in result else 401
-    return JSONResponse(result, status_code=status_code)
+    status_code, result = await _sso_me(get_session(request))
+    return Response(
+        content=orjson.dumps(result), status_code=status_code, media_type="application/json"
+    )
 
 
 @app.post("/sso_logout")
@@ -215,9 +443,14 @@ async def sso_logout_http(request: Request):
     Browser-accessible endpoint: POST /sso_logout
     """
     logger.info("HTTP /sso_logout called")
-    result = sso_logout()
-    status_code = 200 if result.get("status") == "ok" else 500
-    return JSONResponse(result, status_code=status_code)
+    session_id = request.cookies.get(AGENT_SESSION_COOKIE)
+    session = app.state.sessions.pop(session_id, {}) if session_id else {}
+    status_code, result = await _sso_logout(session)
+    response = Response(
+        content=orjson.dumps(result), status_code=status_code, media_type="application/json"
+    )
+    response.delete_cookie(AGENT_SESSION_COOKIE)
+    return response
 
 
 # ---------------------------------------------------------------------------
@@ -237,5 +470,23 @@ if __name__ == "__main__":
     import uvicorn
 
     logger.info("Starting MCP SSO Server on port 8090")
-    logger.info(f"Backend URL: {BACKEND_BASE_URL}")
-    uvicorn.run(app, host="0.0.0.0", port=8090)
+    logger.info("Backend URL: %s", BACKEND_BASE_URL)
+    # Agent sessions and FastMCP's streamable-HTTP sessions live in this
+    # process's memory, and uvicorn workers share one listening socket, so a
+    # client cannot be pinned to a worker: scale with separate instances
+    # behind a sticky load balancer instead.
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    if workers > 1:
+        logger.error(
+            "WEB_CONCURRENCY=%d is not supported: sessions are per-process; "
+            "run one worker per instance",
+            workers,
+        )
+        raise SystemExit(1)
+
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=8090,
+        log_level=LOG_LEVEL.lower(),
+    )
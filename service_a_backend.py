@@ -1,20 +1,27 @@
 import os
+import asyncio
 import jwt
 import logging
 import secrets
+import ssl
+import time
 import hashlib
 import base64
 from typing import Optional
+from urllib.parse import quote
 
+from cachetools import TTLCache
+from jwt import PyJWKClient
 from fastapi import FastAPI, Request, Response, HTTPException, status, Cookie
-from fastapi.responses import RedirectResponse, JSONResponse
+from fastapi.responses import RedirectResponse, ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from msal import ConfidentialClientApplication
+from pydantic import BaseModel
 from dotenv import load_dotenv
 
 load_dotenv()
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # CORS (demo: allow all - restrict in prod)
 app.add_middleware(
@@ -33,6 +40,8 @@ REDIRECT_URI = os.getenv("REDIRECT_URI")  # IMPORTANT: for local, set to your HT
 COOKIE_SECRET = os.getenv("COOKIE_SECRET", "changeme")
 COOKIE_NAME = os.getenv("COOKIE_NAME", "sso_session")
 AUTH_BASE_URL = os.getenv("AUTH_BASE_URL", "http://localhost:8000")
+# How long (seconds) a login's state/PKCE verifier waits for its callback
+AUTH_STATE_TTL = int(os.getenv("AUTH_STATE_TTL", "600"))
 
 # Validate required environment variables
 REQUIRED_ENV_VARS = {
@@ -59,6 +68,35 @@ if DISABLE_SSL_VERIFY:
     import urllib3
     urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# One MSAL app for the process; its calls do blocking HTTPS I/O, so handlers
+# run them via asyncio.to_thread to keep the event loop free.
+_MSAL_APP = ConfidentialClientApplication(
+    CLIENT_ID,
+    authority=AUTHORITY,
+    client_credential=CLIENT_SECRET,
+    verify=not DISABLE_SSL_VERIFY,
+)
+
+# Azure AD signing keys for id_token verification (parsed keys cached for an hour)
+_JWKS_SSL_CONTEXT = None
+if DISABLE_SSL_VERIFY:
+    _JWKS_SSL_CONTEXT = ssl.create_default_context()
+    _JWKS_SSL_CONTEXT.check_hostname = False
+    _JWKS_SSL_CONTEXT.verify_mode = ssl.CERT_NONE
+_JWKS = PyJWKClient(
+    f"{AUTHORITY}/discovery/v2.0/keys",
+    cache_keys=True,
+    lifespan=3600,
+    ssl_context=_JWKS_SSL_CONTEXT,
+)
+# Expected id_token issuer (TENANT_ID must be the tenant GUID for this to match)
+ID_TOKEN_ISSUER = f"{AUTHORITY}/v2.0"
+# Allowed clock skew (seconds) against Azure AD when checking exp/nbf/iat
+JWT_LEEWAY = int(os.getenv("JWT_LEEWAY", "60"))
+# Verified id_token claims keyed by SHA-256 of the token, so repeated
+# /auth/me polls skip the RSA signature check
+_VERIFIED_TOKENS = TTLCache(maxsize=50_000, ttl=60)
+
 # Logging
 LOG_LEVEL = os.getenv("LOG_LEVEL", "info").upper()
 logging.basicConfig(
@@ -67,10 +105,40 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Session state storage (demo: in-memory)
-session_states = {}
+# Session state storage (demo: in-memory). Abandoned logins expire after
+# AUTH_STATE_TTL. Only touched from async handlers on the event loop, with no
+# await between lookup and pop, so no lock is needed.
+session_states = TTLCache(maxsize=10_000, ttl=AUTH_STATE_TTL)
 # PKCE code verifier storage (state -> code_verifier)
-pkce_verifiers = {}
+pkce_verifiers = TTLCache(maxsize=10_000, ttl=AUTH_STATE_TTL)
+
+_STATE_PLACEHOLDER = "__STATE__"
+
+
+def _build_auth_url_template() -> Optional[str]:
+    """
+    Build the authorize URL with everything but state pre-encoded, so
+    /auth/login only substitutes the state. Checked once against MSAL with a
+    probe state; returns None (build per request) if substitution differs.
+    """
+    template = _MSAL_APP.get_authorization_request_url(
+        scopes=SCOPE,
+        redirect_uri=REDIRECT_URI,
+        state=_STATE_PLACEHOLDER,
+    )
+    probe_state = secrets.token_urlsafe(32)
+    expected = _MSAL_APP.get_authorization_request_url(
+        scopes=SCOPE,
+        redirect_uri=REDIRECT_URI,
+        state=probe_state,
+    )
+    if template.replace(_STATE_PLACEHOLDER, quote(probe_state, safe="")) != expected:
+        logger.warning("MSAL authorize URL is not stable; building it per request")
+        return None
+    return template
+
+
+_AUTH_URL_TEMPLATE = _build_auth_url_template()
 
 
 def generate_pkce_pair():
@@ -86,24 +154,47 @@ def generate_pkce_pair():
     return code_verifier, code_challenge
 
 
+def acquire_token_by_code(**token_request_data) -> dict:
+    """Redeem an auth code on the shared MSAL app (blocking)"""
+    result = _MSAL_APP.acquire_token_by_authorization_code(**token_request_data)
+    # Nothing reads the MSAL cache back, so drop the user's tokens right away
+    # instead of letting the shared app accumulate every user's tokens.
+    claims = result.get("id_token_claims", {})
+    local_account_id = claims.get("oid") or claims.get("sub")
+    if local_account_id:
+        for account in _MSAL_APP.get_accounts():
+            if account.get("local_account_id") == local_account_id:
+                _MSAL_APP.remove_account(account)
+    return result
+
+
+def verify_id_token(id_token: str) -> dict:
+    """Verify an id_token's signature, audience and issuer; return its claims (blocking on JWKS miss)"""
+    signing_key = _JWKS.get_signing_key_from_jwt(id_token).key
+    # Azure AD signs every tenant's tokens with the same keys, so the issuer
+    # check is what rejects tokens minted by another tenant for CLIENT_ID
+    return jwt.decode(
+        id_token,
+        signing_key,
+        algorithms=["RS256"],
+        audience=CLIENT_ID,
+        issuer=ID_TOKEN_ISSUER,
+        leeway=JWT_LEEWAY,
+        options={"require": ["exp", "iss", "aud"]},
+    )
+
+
 @app.get("/health")
-def health():
+async def health():
     return {"status": "ok"}
 
 
 @app.get("/auth/login")
-def auth_login():
+async def auth_login():
     """
     Start login: return a redirect to Azure authorize endpoint with PKCE.
     The redirect_uri here MUST match REDIRECT_URI / Entra app config.
     """
-    app_msal = ConfidentialClientApplication(
-        CLIENT_ID,
-        authority=AUTHORITY,
-        client_credential=CLIENT_SECRET,
-        verify=not DISABLE_SSL_VERIFY,
-    )
-    
     # Generate PKCE pair
     code_verifier, code_challenge = generate_pkce_pair()
     
@@ -113,28 +204,27 @@ def auth_login():
     # Store code_verifier for this state
     pkce_verifiers[state] = code_verifier
     
-    auth_url = app_msal.get_authorization_request_url(
-        scopes=SCOPE,
-        redirect_uri=REDIRECT_URI,
-        state=state,
-    )
+    if _AUTH_URL_TEMPLATE is not None:
+        auth_url = _AUTH_URL_TEMPLATE.replace(_STATE_PLACEHOLDER, quote(state, safe=""))
+    else:
+        auth_url = await asyncio.to_thread(
+            _MSAL_APP.get_authorization_request_url,
+            scopes=SCOPE,
+            redirect_uri=REDIRECT_URI,
+            state=state,
+        )
     
     # Add PKCE parameters to the auth URL
     auth_url += f"&code_challenge={code_challenge}&code_challenge_method=S256"
     
-    logger.info(f"Login initiated with state: {state[:10]}... and PKCE")
+    logger.info("Login initiated with state: %s... and PKCE", state[:10])
     return RedirectResponse(auth_url)
 
 
-@app.get("/auth/callback")
-def auth_callback(
-    request: Request,
-    response: Response,
-    code: Optional[str] = None,
-    state: Optional[str] = None,
-):
+async def redeem_auth_code(code: Optional[str], state: Optional[str]) -> dict:
     """
-    Exchange the auth code for tokens.
+    Validate state and redeem the auth code (with its PKCE verifier).
+    Returns MSAL's token result; raises HTTPException if login failed.
 
     NOTE: redirect_uri here MUST be the same value Azure used
     when issuing the code (i.e., your HTML page URL when
@@ -145,19 +235,11 @@ def auth_callback(
 
     # Validate state and retrieve code_verifier
     code_verifier = None
-    if state and state in session_states:
-        session_states.pop(state)
+    if state and session_states.pop(state, None):
         code_verifier = pkce_verifiers.pop(state, None)
-        logger.info(f"State validated: {state[:10]}... with PKCE")
+        logger.info("State validated: %s... with PKCE", state[:10])
     else:
-        logger.warning(f"Invalid or missing state: {state}")
-
-    app_msal = ConfidentialClientApplication(
-        CLIENT_ID,
-        authority=AUTHORITY,
-        client_credential=CLIENT_SECRET,
-        verify=not DISABLE_SSL_VERIFY,
-    )
+        logger.warning("Invalid or missing state: %s", state)
 
     # Include code_verifier in token request for PKCE
     token_request_data = {
@@ -170,13 +252,27 @@ def auth_callback(
         token_request_data["code_verifier"] = code_verifier
         logger.info("Using PKCE code_verifier for token exchange")
 
-    result = app_msal.acquire_token_by_authorization_code(**token_request_data)
+    result = await asyncio.to_thread(acquire_token_by_code, **token_request_data)
 
     if "id_token" not in result:
-        logger.error(f"Token acquisition failed: {result.get('error')}")
+        logger.error("Token acquisition failed: %s", result.get('error'))
         raise HTTPException(status_code=401, detail="Failed to authenticate")
 
     logger.info("Token acquired successfully")
+    return result
+
+
+@app.get("/auth/callback")
+async def auth_callback(
+    request: Request,
+    response: Response,
+    code: Optional[str] = None,
+    state: Optional[str] = None,
+):
+    """
+    Exchange the auth code for tokens and set the session cookie (browser flow).
+    """
+    result = await redeem_auth_code(code, state)
 
     # Set session cookie (demo: id_token only; use proper session in prod)
     resp = RedirectResponse(url="/post-login")
@@ -191,15 +287,36 @@ def auth_callback(
     return resp
 
 
+class ExchangeRequest(BaseModel):
+    code: str
+    state: Optional[str] = None
+
+
+@app.post("/auth/exchange")
+async def auth_exchange(body: ExchangeRequest):
+    """
+    Exchange the auth code for tokens and return the id_token as JSON
+    (agent flow: no redirect, no cookie - the caller keeps the token).
+    """
+    result = await redeem_auth_code(body.code, body.state)
+    return {
+        "id_token": result["id_token"],
+        "expires_on": result.get("id_token_claims", {}).get("exp"),
+    }
+
+
 @app.get("/auth/me")
-def auth_me(sso_session: Optional[str] = Cookie(None)):
+async def auth_me(sso_session: Optional[str] = Cookie(None)):
     if not sso_session:
         logger.debug("No session cookie found")
-        return JSONResponse(status_code=status.HTTP_401_UNAUTHORIZED, content={"error": "unauthenticated"})
+        return ORJSONResponse(status_code=status.HTTP_401_UNAUTHORIZED, content={"error": "unauthenticated"})
 
     try:
-        # Demo: decode without verification. In production, verify signature.
-        decoded = jwt.decode(sso_session, options={"verify_signature": False})
+        cache_key = hashlib.sha256(sso_session.encode("utf-8")).digest()
+        decoded = _VERIFIED_TOKENS.get(cache_key)
+        if decoded is None or decoded.get("exp", 0) + JWT_LEEWAY <= time.time():
+            decoded = await asyncio.to_thread(verify_id_token, sso_session)
+            _VERIFIED_TOKENS[cache_key] = decoded
 
         user_info = {
             "sub": decoded.get("sub", decoded.get("oid")),
@@ -210,17 +327,23 @@ def auth_me(sso_session: Optional[str] = Cookie(None)):
             "name": decoded.get("name", "Unknown User"),
         }
 
-        logger.info(f"User authenticated: {user_info.get('email', 'unknown')}")
+        logger.info("User authenticated: %s", user_info.get('email', 'unknown'))
         return {"user": user_info}
-    except jwt.DecodeError as e:
-        logger.error(f"JWT decode error: {e}")
-        return JSONResponse(
+    except jwt.PyJWKClientConnectionError as e:
+        logger.error("Cannot fetch signing keys: %s", e)
+        return ORJSONResponse(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            content={"error": "jwks_unavailable"},
+        )
+    except (jwt.InvalidTokenError, jwt.PyJWKClientError) as e:
+        logger.error("JWT verification error: %s", e)
+        return ORJSONResponse(
             status_code=status.HTTP_401_UNAUTHORIZED,
             content={"error": "invalid_token"},
         )
     except Exception as e:
-        logger.error(f"Unexpected error in auth_me: {e}")
-        return JSONResponse(
+        logger.error("Unexpected error in auth_me: %s", e)
+        return ORJSONResponse(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             content={"error": "internal_error"},
         )
@@ -229,14 +352,14 @@ def auth_me(sso_session: Optional[str] = Cookie(None)):
 
 
 @app.post("/auth/logout")
-def auth_logout(response: Response):
+async def auth_logout(response: Response):
     response.delete_cookie(COOKIE_NAME)
     logger.info("User logged out")
     return {"status": "ok"}
 
 
 @app.get("/post-login")
-def post_login():
+async def post_login():
     """Simple success page after login"""
     return {"status": "ok", "message": "Login successful"}
 
@@ -254,4 +377,9 @@ if __name__ == "__main__":
     print(f"📡 Authority: {AUTHORITY}")
     print("=" * 60)
     
-    uvicorn.run(app, host="0.0.0.0", port=8000, log_level=LOG_LEVEL.lower())
\ No newline at end of file
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=8000,
+        log_level=LOG_LEVEL.lower(),
+    )
\ No newline at end of file
@@ -1,12 +1,20 @@
 import os
+import base64
+import hashlib
+import hmac
 import logging
-from typing import Optional, Dict, Any
-import socket
+import secrets
+import time
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, Any, Tuple
 
 import httpx
+import jwt
+import orjson
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute
+from fastapi.responses import ORJSONResponse, Response
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -17,23 +25,40 @@ load_dotenv()
 
 BACKEND_BASE_URL = os.getenv("BACKEND_BASE_URL", "http://localhost:8000")
 
-# Test if backend port is reachable
-def test_backend_port():
-    """Test if backend port 8000 is reachable"""
-    try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(2)
-        result = sock.connect_ex(('127.0.0.1', 8000))
-        sock.close()
-        if result == 0:
-            logger.info("✅ Backend port 8000 is REACHABLE")
-            return True
-        else:
-            logger.error(f"❌ Backend port 8000 is NOT reachable (error code: {result})")
-            return False
-    except Exception as e:
-        logger.error(f"❌ Cannot test backend port: {e}")
-        return False
+# Connection pool for the shared backend client (size to expected MCP fan-out)
+MCP_HTTP_MAX_CONN = int(os.getenv("MCP_HTTP_MAX_CONN", "500"))
+MCP_HTTP_MAX_KEEPALIVE = int(os.getenv("MCP_HTTP_MAX_KEEPALIVE", "100"))
+MCP_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("MCP_HTTP_KEEPALIVE_EXPIRY", "30"))
+# Offer HTTP/2 to the backend (negotiated via TLS ALPN; plain http:// stays HTTP/1.1)
+MCP_HTTP2 = os.getenv("MCP_HTTP2", "true").lower() == "true"
+
+# Browser origins allowed to call the agent with credentials (comma-separated;
+# no "*" - credentialed CORS needs explicit origins)
+CORS_ORIGINS = frozenset(
+    origin.strip()
+    for origin in os.getenv(
+        "CORS_ORIGINS",
+        "http://localhost:5500,http://127.0.0.1:5500,http://localhost:3000,http://127.0.0.1:3000",
+    ).split(",")
+    if origin.strip()
+)
+
+# Per-browser agent sessions: cookie name and absolute session lifetime
+# (seconds). Sessions expire this long after login; access does not extend them.
+AGENT_SESSION_COOKIE = os.getenv("AGENT_SESSION_COOKIE", "agent_session")
+AGENT_SESSION_TTL = int(os.getenv("AGENT_SESSION_TTL", "3600"))
+# Key for the HMAC that signs the agent session cookie. Must be set (and be the
+# same everywhere) when running several workers or replicas; unset = a random
+# per-process key, so sessions do not survive a restart.
+AGENT_SESSION_SECRET = os.getenv("AGENT_SESSION_SECRET")
+_AGENT_SESSION_KEY = (
+    AGENT_SESSION_SECRET.encode("utf-8") if AGENT_SESSION_SECRET else secrets.token_bytes(32)
+)
+
+# Backend session cookie name (carries the id_token on backend calls) and how
+# long (seconds) the token must still be valid for /sso_me to answer locally
+SSO_COOKIE_NAME = os.getenv("COOKIE_NAME", "sso_session")
+LOCAL_ME_MIN_TTL = int(os.getenv("LOCAL_ME_MIN_TTL", "60"))
 
 LOG_LEVEL = os.getenv("LOG_LEVEL", "info").upper()
 logging.basicConfig(
@@ -42,204 +67,334 @@ logging.basicConfig(
 )
 logger = logging.getLogger("sso_agent")
 
-# In-memory cookie jar for the agent session (demo only)
-session_cookies: Dict[str, Any] = {}
-
 # ---------------------------------------------------------------------------
 # FastAPI app
 # ---------------------------------------------------------------------------
 
-app = FastAPI(title="SSO Agent")
+class ORJSONRoute(APIRoute):
+    """
+    Route that pre-parses JSON request bodies with orjson, so a later
+    `await request.json()` returns the cached result. Invalid JSON is left
+    for request.json() to reject as usual.
+    """
+
+    def get_route_handler(self):
+        original = super().get_route_handler()
+
+        async def custom_route_handler(request: Request):
+            body = await request.body()
+            if body:
+                try:
+                    request._json = orjson.loads(body)
+                except orjson.JSONDecodeError:
+                    pass
+            return await original(request)
 
-# CORS for your static HTML (adjust origins if needed)
+        return custom_route_handler
+
+
+async def check_backend(client: httpx.AsyncClient) -> bool:
+    """Check that the backend answers /health (logs the result, never raises)"""
+    try:
+        resp = await client.get("/health", timeout=2.0)
+        if resp.is_success:
+            logger.info("✅ Backend %s is REACHABLE (%s)", BACKEND_BASE_URL, resp.http_version)
+            if MCP_HTTP2 and resp.http_version != "HTTP/2":
+                logger.info("Backend did not negotiate HTTP/2; calls use pooled HTTP/1.1")
+            return True
+        logger.error("❌ Backend %s/health returned %s", BACKEND_BASE_URL, resp.status_code)
+        return False
+    except httpx.HTTPError as e:
+        logger.error("❌ Backend %s is NOT reachable: %s", BACKEND_BASE_URL, e)
+        return False
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Create one shared AsyncClient for the app lifetime so every request
+    reuses the same keep-alive connection pool to the backend.
+    """
+    app.state.http = httpx.AsyncClient(
+        base_url=BACKEND_BASE_URL,
+        follow_redirects=False,
+        timeout=30.0,
+        http2=MCP_HTTP2,
+        verify=False,
+        limits=httpx.Limits(
+            max_connections=MCP_HTTP_MAX_CONN,
+            max_keepalive_connections=MCP_HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=MCP_HTTP_KEEPALIVE_EXPIRY,
+        ),
+    )
+    logger.info("Testing backend connectivity...")
+    await check_backend(app.state.http)
+    try:
+        yield
+    finally:
+        await app.state.http.aclose()
+
+
+app = FastAPI(
+    title="SSO Agent",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
+)
+# Must be set before any route is declared
+app.router.route_class = ORJSONRoute
+
+# CORS for your static HTML (set CORS_ORIGINS to adjust origins)
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=[
-        "http://localhost:5500",
-        "http://127.0.0.1:5500",
-        "http://localhost:3000",
-        "http://127.0.0.1:3000",
-        "*",  # demo: allow all; tighten this in prod
-    ],
+    allow_origins=list(CORS_ORIGINS),
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["content-type", "authorization"],
 )
 
 
 # ---------------------------------------------------------------------------
 # Helper Functions
 # ---------------------------------------------------------------------------
+# handle_sso_* return (status_code, body) with the body already serialized to
+# JSON bytes, so endpoints send it as-is without re-inspecting or re-encoding.
+
+
+def session_cookie_header(session: Dict[str, Any]) -> Dict[str, str]:
+    """
+    Build the backend session Cookie header from the session's id_token.
+    (The shared client has no per-user cookie jar.)
+    """
+    id_token = session.get("id_token")
+    if not id_token:
+        return {}
+    return {"Cookie": f"{SSO_COOKIE_NAME}={id_token}"}
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
 
 
-def handle_sso_login() -> dict:
+def encode_session(session: Dict[str, Any]) -> str:
+    """
+    Serialize a session into the agent session cookie value:
+    base64url(JSON payload) "." base64url(HMAC-SHA256 of the payload).
+    The session lives in the browser, so any worker can read it back.
+    """
+    payload = _b64encode(
+        orjson.dumps({**session, "session_exp": int(time.time()) + AGENT_SESSION_TTL})
+    )
+    signature = hmac.new(_AGENT_SESSION_KEY, payload.encode("ascii"), hashlib.sha256).digest()
+    return f"{payload}.{_b64encode(signature)}"
+
+
+def decode_session(value: str) -> Dict[str, Any]:
+    """Verify and decode an agent session cookie value; empty if invalid or expired"""
+    payload, _, signature = value.partition(".")
+    try:
+        expected = hmac.new(_AGENT_SESSION_KEY, payload.encode("ascii"), hashlib.sha256).digest()
+        if not hmac.compare_digest(_b64decode(signature), expected):
+            return {}
+        session = orjson.loads(_b64decode(payload))
+    except ValueError:  # bad base64/ASCII or JSON (orjson.JSONDecodeError)
+        return {}
+    if not isinstance(session, dict) or session.pop("session_exp", 0) <= time.time():
+        return {}
+    return session
+
+
+def get_session(request: Request) -> Dict[str, Any]:
+    """
+    Return the caller's agent session (holds the id_token).
+    Empty if the browser has no valid agent session or it has expired.
+    """
+    value = request.cookies.get(AGENT_SESSION_COOKIE)
+    if not value:
+        return {}
+    return decode_session(value)
+
+
+def user_from_session(session: Dict[str, Any]) -> Optional[dict]:
+    """
+    Decode the session's id_token locally and return its user info.
+    The token came straight from the backend (never from the browser), so no
+    signature check is needed here. Returns None if the token is missing or
+    unreadable, or if the session's expires_on is unknown or within
+    LOCAL_ME_MIN_TTL seconds (checked before decoding).
+    """
+    id_token = session.get("id_token")
+    expires_on = session.get("expires_on")
+    if not id_token or not expires_on or expires_on <= time.time() + LOCAL_ME_MIN_TTL:
+        return None
+    try:
+        decoded = jwt.decode(id_token, options={"verify_signature": False})
+    except jwt.DecodeError:
+        return None
+    return {
+        "sub": decoded.get("sub", decoded.get("oid")),
+        "email": decoded.get(
+            "email",
+            decoded.get("preferred_username", decoded.get("upn")),
+        ),
+        "name": decoded.get("name", "Unknown User"),
+    }
+
+
+async def handle_sso_login(client: httpx.AsyncClient) -> Tuple[int, bytes]:
     """
     Start SSO login and return the Azure auth URL.
     Calls the backend /auth/login endpoint.
     """
     try:
-        logger.info(f"Calling backend /auth/login at {BACKEND_BASE_URL}")
-        # Disable SSL verification and set HTTP/1.1 explicitly
-        with httpx.Client(
-            base_url=BACKEND_BASE_URL, 
-            follow_redirects=False, 
-            timeout=30.0,
-            verify=False,
-            http2=False
-        ) as client:
-            resp = client.get("/auth/login")
-            
-            logger.info(f"Backend response status: {resp.status_code}")
-            logger.info(f"Backend response headers: {dict(resp.headers)}")
-            
-            if resp.is_redirect:
-                auth_url = resp.headers.get("location")
-                logger.info(f"SSO login initiated, auth_url: {auth_url}")
-                return {"auth_url": auth_url}
-            
-            # Not a redirect - log response body for debugging
+        logger.info("Calling backend /auth/login at %s", BACKEND_BASE_URL)
+        resp = await client.get("/auth/login")
+
+        logger.debug("Backend response status: %s", resp.status_code)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Backend response headers: %s", dict(resp.headers))
+
+        if resp.is_redirect:
+            auth_url = resp.headers.get("location")
+            logger.info("SSO login initiated, auth_url: %s", auth_url)
+            return 200, orjson.dumps({"auth_url": auth_url})
+
+        # Not a redirect - log response body for debugging
+        try:
+            body = resp.text
+            logger.error("Backend /auth/login did not redirect. Status: %s, Body: %s", resp.status_code, body)
+
+            # Try to parse as JSON
             try:
-                body = resp.text
-                logger.error(f"Backend /auth/login did not redirect. Status: {resp.status_code}, Body: {body}")
-                
-                # Try to parse as JSON
-                try:
-                    json_data = resp.json()
-                    return {"error": f"backend_error: {json_data}"}
-                except:
-                    return {"error": f"backend_error: {body}"}
-            except Exception as e:
-                logger.error(f"Login failed (could not read response): {e}")
-                return {"error": "login failed - no response body"}
-                
+                json_data = resp.json()
+                return 500, orjson.dumps({"error": f"backend_error: {json_data}"})
+            except:
+                return 500, orjson.dumps({"error": f"backend_error: {body}"})
+        except Exception as e:
+            logger.error("Login failed (could not read response): %s", e)
+            return 500, orjson.dumps({"error": "login failed - no response body"})
+
     except httpx.ConnectError as e:
-        logger.error(f"Cannot connect to backend at {BACKEND_BASE_URL}: {e}")
-        return {"error": f"connection_error: Cannot reach backend. Is service_a_backend.py running on port 8000?"}
+        logger.error("Cannot connect to backend at %s: %s", BACKEND_BASE_URL, e)
+        return 500, orjson.dumps({"error": f"connection_error: Cannot reach backend. Is service_a_backend.py running on port 8000?"})
     except httpx.TimeoutException as e:
-        logger.error(f"Timeout connecting to backend: {e}")
-        return {"error": "connection_error: Backend timeout"}
+        logger.error("Timeout connecting to backend: %s", e)
+        return 500, orjson.dumps({"error": "connection_error: Backend timeout"})
     except Exception as e:
-        logger.error(f"Unexpected error during login: {e}", exc_info=True)
-        return {"error": f"connection_error: {str(e)}"}
+        logger.error("Unexpected error during login: %s", e, exc_info=True)
+        return 500, orjson.dumps({"error": f"connection_error: {str(e)}"})
 
 
-def handle_sso_callback(code: str, state: Optional[str] = None) -> dict:
+async def handle_sso_callback(
+    client: httpx.AsyncClient,
+    session: Dict[str, Any],
+    code: str,
+    state: Optional[str] = None,
+) -> Tuple[int, bytes]:
     """
-    Handle SSO callback and store session cookies for the agent.
-    Calls the backend /auth/callback endpoint.
+    Handle SSO callback and store the id_token into session.
+    Calls the backend /auth/exchange endpoint, which returns the token as
+    JSON instead of redirecting with a cookie.
     """
     try:
-        logger.info(f"handle_sso_callback called with code: {code[:20]}...")
-        params = {"code": code}
+        logger.info("handle_sso_callback called with code: %s...", code[:20])
+        payload = {"code": code}
         if state:
-            params["state"] = state
-
-        with httpx.Client(
-            base_url=BACKEND_BASE_URL, 
-            follow_redirects=False, 
-            timeout=30.0,
-            verify=False,
-            http2=False
-        ) as client:
-            resp = client.get("/auth/callback", params=params)
-
-            logger.info(f"Callback response status: {resp.status_code}")
-            
-            # Store cookies from backend in our in-memory jar
-            if resp.cookies:
-                session_cookies.clear()
-                session_cookies.update(resp.cookies)
-                logger.info(f"Session cookies stored: {len(resp.cookies)} cookie(s)")
-
-            if resp.is_redirect:
-                # Backend redirects to /post-login on success
-                logger.info("Callback successful, session established")
-                return {"status": "OK"}
-
-            # If backend returned JSON instead of redirect, pass it through
-            try:
-                json_data = resp.json()
-                logger.warning(f"Callback did not redirect, returned: {json_data}")
-                return json_data
-            except Exception as e:
-                body = resp.text
-                logger.error(f"Callback failed. Status: {resp.status_code}, Body: {body}")
-                return {"error": f"callback failed: {body}"}
-                
+            payload["state"] = state
+
+        resp = await client.post("/auth/exchange", json=payload)
+
+        logger.info("Exchange response status: %s", resp.status_code)
+
+        if resp.status_code == 200:
+            tokens = resp.json()
+            session["id_token"] = tokens["id_token"]
+            session["expires_on"] = tokens.get("expires_on")
+            logger.info("Exchange successful, session established")
+            return 200, orjson.dumps({"status": "OK"})
+
+        # Backend rejected the code - pass its JSON error through
+        try:
+            json_data = resp.json()
+            logger.warning("Exchange failed, returned: %s", json_data)
+            return 500, orjson.dumps(json_data)
+        except Exception as e:
+            body = resp.text
+            logger.error("Exchange failed. Status: %s, Body: %s", resp.status_code, body)
+            return 500, orjson.dumps({"error": f"callback failed: {body}"})
+
     except httpx.ConnectError as e:
-        logger.error(f"Cannot connect to backend: {e}")
-        return {"error": "connection_error: Cannot reach backend"}
+        logger.error("Cannot connect to backend: %s", e)
+        return 500, orjson.dumps({"error": "connection_error: Cannot reach backend"})
     except Exception as e:
-        logger.error(f"Connection error during callback: {e}", exc_info=True)
-        return {"error": f"connection_error: {str(e)}"}
+        logger.error("Connection error during callback: %s", e, exc_info=True)
+        return 500, orjson.dumps({"error": f"connection_error: {str(e)}"})
 
 
-def handle_sso_me() -> dict:
+async def handle_sso_me(
+    client: httpx.AsyncClient, session: Dict[str, Any]
+) -> Tuple[int, bytes]:
     """
     Get user info if authenticated.
-    Uses the session_cookies stored during callback.
-    Calls the backend /auth/me endpoint.
+    Uses the id_token stored during callback: answers locally when it is
+    still valid, else calls the backend /auth/me.
     """
+    user_info = user_from_session(session)
+    if user_info is not None:
+        logger.info("User info from local id_token: %s", user_info.get('email', 'unknown'))
+        return 200, orjson.dumps({"user": user_info})
+
     try:
-        logger.info(f"Calling /auth/me with {len(session_cookies)} cookies")
-        with httpx.Client(
-            base_url=BACKEND_BASE_URL, 
-            cookies=session_cookies, 
-            timeout=30.0,
-            verify=False,
-            http2=False
-        ) as client:
-            resp = client.get("/auth/me")
-            result = resp.json()
-            
-            if resp.status_code == 200:
-                logger.info(
-                    f"User info retrieved: "
-                    f"{result.get('user', {}).get('email', 'unknown')}"
-                )
-            else:
-                logger.debug(f"Not authenticated or error (status {resp.status_code}): {result}")
-            return result
-            
+        logger.debug("Calling /auth/me (has token: %s)", "id_token" in session)
+        resp = await client.get("/auth/me", headers=session_cookie_header(session))
+        result = resp.json()
+
+        if resp.status_code == 200:
+            logger.info(
+                "User info retrieved: %s",
+                result.get('user', {}).get('email', 'unknown'),
+            )
+        else:
+            logger.debug("Not authenticated or error (status %s): %s", resp.status_code, result)
+        return (200 if resp.status_code == 200 else 401), orjson.dumps(result)
+
     except httpx.ConnectError as e:
-        logger.error(f"Cannot connect to backend: {e}")
-        return {"error": "connection_error: Cannot reach backend"}
+        logger.error("Cannot connect to backend: %s", e)
+        return 401, orjson.dumps({"error": "connection_error: Cannot reach backend"})
     except Exception as e:
-        logger.error(f"Error getting user info: {e}", exc_info=True)
-        return {"error": f"me failed: {str(e)}"}
+        logger.error("Error getting user info: %s", e, exc_info=True)
+        return 401, orjson.dumps({"error": f"me failed: {str(e)}"})
 
 
-def handle_sso_logout() -> dict:
+async def handle_sso_logout(
+    client: httpx.AsyncClient, session: Dict[str, Any]
+) -> Tuple[int, bytes]:
     """
-    Logout and clear agent session cookies.
+    Logout and clear the agent session.
     Calls the backend /auth/logout endpoint.
     """
     try:
         logger.info("Logging out user")
-        with httpx.Client(
-            base_url=BACKEND_BASE_URL, 
-            cookies=session_cookies, 
-            timeout=30.0,
-            verify=False,
-            http2=False
-        ) as client:
-            resp = client.post("/auth/logout")
-            session_cookies.clear()
-            logger.info("User logged out, session cleared")
-            try:
-                return resp.json()
-            except Exception as e:
-                logger.error(f"Logout response parse error: {e}")
-                return {"status": "ok"}  # Still clear session even if parse fails
-                
+        resp = await client.post("/auth/logout", headers=session_cookie_header(session))
+        session.clear()
+        logger.info("User logged out, session cleared")
+        try:
+            return (200 if resp.is_success else 500), orjson.dumps(resp.json())
+        except Exception as e:
+            logger.error("Logout response parse error: %s", e)
+            return 200, orjson.dumps({"status": "ok"})  # Still clear session even if parse fails
+
     except httpx.ConnectError as e:
-        logger.error(f"Cannot connect to backend: {e}")
-        session_cookies.clear()  # Clear local session anyway
-        return {"error": "connection_error: Cannot reach backend (session cleared locally)"}
+        logger.error("Cannot connect to backend: %s", e)
+        session.clear()  # Clear local session anyway
+        return 500, orjson.dumps({"error": "connection_error: Cannot reach backend (session cleared locally)"})
     except Exception as e:
-        logger.error(f"Connection error during logout: {e}", exc_info=True)
-        session_cookies.clear()  # Clear local session anyway
-        return {"error": f"connection_error: {str(e)}"}
+        logger.error("Connection error during logout: %s", e, exc_info=True)
+        session.clear()  # Clear local session anyway
+        return 500, orjson.dumps({"error": f"connection_error: {str(e)}"})
     
 
 # ---------------------------------------------------------------------------
@@ -254,7 +409,6 @@ async def health():
         "status": "ok",
         "service": "sso_agent",
         "backend_url": BACKEND_BASE_URL,
-        "active_sessions": len(session_cookies)
     }
 
 
@@ -265,9 +419,8 @@ async def sso_login_endpoint(request: Request):
     Returns the Azure authorization URL for SSO login.
     """
     logger.info("HTTP /sso_login called")
-    result = handle_sso_login()
-    status_code = 200 if "error" not in result else 500
-    return JSONResponse(result, status_code=status_code)
+    status_code, result = await handle_sso_login(request.app.state.http)
+    return Response(content=result, status_code=status_code, media_type="application/json")
 
 
 @app.post("/sso_callback")
@@ -281,18 +434,33 @@ async def sso_callback_endpoint(request: Request):
     try:
         body = await request.json()
     except Exception as e:
-        logger.error(f"Failed to parse request body: {e}")
-        return JSONResponse({"error": "invalid JSON body"}, status_code=400)
+        logger.error("Failed to parse request body: %s", e)
+        return ORJSONResponse({"error": "invalid JSON body"}, status_code=400)
     
     code = body.get("code")
     state = body.get("state")
 
     if not code:
-        return JSONResponse({"error": "missing code"}, status_code=400)
-
-    result = handle_sso_callback(code=code, state=state)
-    status_code = 200 if result.get("status") == "OK" and "error" not in result else 500
-    return JSONResponse(result, status_code=status_code)
+        return ORJSONResponse({"error": "missing code"}, status_code=400)
+
+    session: Dict[str, Any] = {}
+    status_code, result = await handle_sso_callback(
+        request.app.state.http, session, code=code, state=state
+    )
+    response = Response(content=result, status_code=status_code, media_type="application/json")
+    if session:
+        # The cookie is rebuilt from this login's tokens (never from the
+        # client's old cookie), so a planted agent_session cannot be fixated.
+        response.set_cookie(
+            key=AGENT_SESSION_COOKIE,
+            value=encode_session(session),
+            max_age=AGENT_SESSION_TTL,
+            httponly=True,
+            # LOCAL DEV: set to False so it works over http://localhost
+            secure=False,
+            samesite="lax",
+        )
+    return response
 
 
 @app.post("/sso_me")
@@ -302,9 +470,8 @@ async def sso_me_endpoint(request: Request):
     Returns authenticated user information.
     """
     logger.info("HTTP /sso_me called")
-    result = handle_sso_me()
-    status_code = 200 if "user" in result else 401
-    return JSONResponse(result, status_code=status_code)
+    status_code, result = await handle_sso_me(request.app.state.http, get_session(request))
+    return Response(content=result, status_code=status_code, media_type="application/json")
 
 
 @app.post("/sso_logout")
@@ -314,9 +481,10 @@ async def sso_logout_endpoint(request: Request):
     Logs out the user and clears session.
     """
     logger.info("HTTP /sso_logout called")
-    result = handle_sso_logout()
-    status_code = 200 if result.get("status") == "ok" else 500
-    return JSONResponse(result, status_code=status_code)
+    status_code, result = await handle_sso_logout(request.app.state.http, get_session(request))
+    response = Response(content=result, status_code=status_code, media_type="application/json")
+    response.delete_cookie(AGENT_SESSION_COOKIE)
+    return response
 
 
 # ---------------------------------------------------------------------------
@@ -328,11 +496,25 @@ if __name__ == "__main__":
 
     logger.info("=" * 60)
     logger.info("Starting SSO Agent on port 8090")
-    logger.info(f"Backend URL: {BACKEND_BASE_URL}")
+    logger.info("Backend URL: %s", BACKEND_BASE_URL)
     logger.info("=" * 60)
     
-    # Test backend connectivity
-    logger.info("Testing backend connectivity...")
-    test_backend_port()
-    
-    uvicorn.run(app, host="0.0.0.0", port=8090)
\ No newline at end of file
+    # Sessions live in the signed cookie, so any worker can serve any browser
+    # as long as all of them verify with the same AGENT_SESSION_SECRET.
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    if workers > 1 and not AGENT_SESSION_SECRET:
+        logger.error(
+            "WEB_CONCURRENCY=%d needs AGENT_SESSION_SECRET so every worker "
+            "accepts the same agent session cookies",
+            workers,
+        )
+        raise SystemExit(1)
+
+    # Import-string form is required by uvicorn when workers > 1
+    uvicorn.run(
+        "sso_agent:app",
+        host="0.0.0.0",
+        port=8090,
+        workers=workers,
+        log_level=LOG_LEVEL.lower(),
+    )
\ No newline at end of file